@@ -1,6 +1,8 @@
 from flask import Flask, request, jsonify, render_template, send_from_directory, session
-from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 import os
+import hmac
+import math
 import base64
 import requests
 import time
@@ -9,6 +11,11 @@ from PIL import Image, ImageDraw
 from io import BytesIO
 import logging
 import config
+import log_config
+import tracing
+from upstream import vision_router, image_router
+from upload_guard import UploadRejected, stream_image_upload
+from static_page import PrecompressedPage
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = config.UPLOAD_FOLDER
@@ -19,18 +26,21 @@ app.config['SESSION_COOKIE_SAMESITE'] = config.SESSION_COOKIE_SAMESITE
 app.config['SESSION_COOKIE_SECURE'] = config.SESSION_COOKIE_SECURE
 app.secret_key = config.SECRET_KEY
 
+log_config.setup_logging()
+
+# PIL 自身的解压炸弹保护与上传像素上限保持一致
+Image.MAX_IMAGE_PIXELS = config.MAX_IMAGE_PIXELS
+
 # Create necessary directories
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['RESULT_FOLDER'], exist_ok=True)
+os.makedirs(config.TRACE_DIR, exist_ok=True)
 
 # Note: We use direct API calls with requests instead of OpenAI client library
 # to avoid version compatibility issues with the OpenAI library
 
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in config.ALLOWED_EXTENSIONS
-
-
+@tracing.traced
 def add_composition_lines(image, line_type='rule_of_thirds', line_color=(255, 36, 66, 180), line_width=2):
     """
     在图片上添加构图线
@@ -97,6 +107,7 @@ def add_composition_lines(image, line_type='rule_of_thirds', line_color=(255, 36
     return img_with_lines
 
 
+@tracing.traced
 def analyze_image_scene(image_path):
     """Analyze image to understand scene, location, and environment"""
     try:
@@ -107,14 +118,8 @@ def analyze_image_scene(image_path):
         prompt = config.SCENE_ANALYSIS_USER_PROMPT
 
         # Use direct API call to avoid OpenAI client library version issues
-        api_url = f"{config.AI_MODELSCOPE_BASE_URL}/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {config.AI_MODELSCOPE_API_KEY}",
-            "Content-Type": "application/json",
-        }
-        
+        # 'model' 由上游路由器按所选上游填充
         payload = {
-            "model": config.VISION_MODEL,
             "messages": [
                 {"role": "system", "content": system_prompt},
                 {
@@ -129,12 +134,8 @@ def analyze_image_scene(image_path):
             "max_tokens": 300,
         }
         
-        response = requests.post(
-            api_url,
-            headers=headers,
-            json=payload,
-            timeout=config.API_REQUEST_TIMEOUT
-        )
+        # 对话补全不在上游创建任务，可安全地在其他上游上重试
+        response, _ = vision_router.request("POST", "chat/completions", payload=payload, idempotent=True)
         response.raise_for_status()
         
         result = response.json()
@@ -147,10 +148,21 @@ def analyze_image_scene(image_path):
         return "户外自然场景"
 
 
+@tracing.traced
 def compress_image_for_api(image_path, max_size_kb=300):
     """Compress image to reduce API payload size - 更激进的压缩"""
+    # 更小的尺寸以适配 API 限制
+    max_dimension = 768  # 从1024降低到768
+    
+    # 像素超限的图片不解码，也不回退为发送原文件
+    with Image.open(image_path) as probe:
+        if probe.size[0] * probe.size[1] > config.MAX_IMAGE_PIXELS:
+            raise ValueError(f"Image too large: {probe.size[0]}x{probe.size[1]}")
+    
     try:
         img = Image.open(image_path)
+        # JPEG 可直接按缩小比例解码，减少解码开销
+        img.draft('RGB', (max_dimension, max_dimension))
         
         # Convert RGBA to RGB if needed
         if img.mode == 'RGBA':
@@ -158,8 +170,6 @@ def compress_image_for_api(image_path, max_size_kb=300):
         elif img.mode not in ['RGB', 'L']:
             img = img.convert('RGB')
         
-        # 更小的尺寸以适配 API 限制
-        max_dimension = 768  # 从1024降低到768
         if max(img.size) > max_dimension:
             ratio = max_dimension / max(img.size)
             new_size = tuple(int(dim * ratio) for dim in img.size)
@@ -190,12 +200,6 @@ def compress_image_for_api(image_path, max_size_kb=300):
 def generate_pose_variant_from_original(image_path, pose_description, scene_context, gender, index):
     """Generate pose illustration using text-to-image (线条小人姿势指导图)"""
     try:
-        base_url = config.IMAGE_MODELSCOPE_BASE_URL
-        common_headers = {
-            "Authorization": f"Bearer {config.IMAGE_MODELSCOPE_API_KEY}",
-            "Content-Type": "application/json",
-        }
-        
         gender_text = "女生" if gender == "female" else "男生"
         
         illustration_prompt = config.ILLUSTRATION_PROMPT_TEMPLATE.format(
@@ -204,26 +208,28 @@ def generate_pose_variant_from_original(image_path, pose_description, scene_cont
         )
         
         logging.info(f"生成姿势指导图 {index}: {pose_description[:50]}...")
-        logging.info(f"Prompt: {illustration_prompt[:100]}...")
+        logging.debug("Prompt: %s...", illustration_prompt[:100])
         
-        # Prepare request payload - 使用Qwen-Image生成
+        # Prepare request payload - 使用Qwen-Image生成（'model' 由上游路由器填充）
         payload = {
-            "model": config.IMAGE_GENERATION_MODEL,  # 使用 Qwen/Qwen-Image
             "prompt": illustration_prompt,
             "n": 1,
             "size": "1024x1024"
         }
         
         logging.info(f"Submitting image generation request {index}...")
-        logging.info(f"Using model: {config.IMAGE_GENERATION_MODEL}")
         
         # Submit async image generation task
-        response = requests.post(
-            f"{base_url}v1/images/generations",
-            headers={**common_headers, "X-ModelScope-Async-Mode": "true"},
-            data=json.dumps(payload, ensure_ascii=False).encode('utf-8'),
-            timeout=config.API_REQUEST_TIMEOUT
-        )
+        with tracing.span('image.submit', index=index):
+            # 提交生成任务不可重复：超时或5xx时上游可能已创建任务，不换key重试
+            response, endpoint = image_router.request(
+                "POST",
+                "v1/images/generations",
+                payload=payload,
+                headers={"X-ModelScope-Async-Mode": "true"},
+                idempotent=False
+            )
+        logging.info(f"Using model: {endpoint.model}")
         
         # Log response for debugging
         logging.info(f"Response status code: {response.status_code}")
@@ -232,7 +238,7 @@ def generate_pose_variant_from_original(image_path, pose_description, scene_cont
             response.raise_for_status()
         
         result_data = response.json()
-        logging.info(f"API Response: {result_data}")
+        logging.debug("API Response: %s", result_data)
         
         task_id = result_data.get("task_id")
         if not task_id:
@@ -241,67 +247,10 @@ def generate_pose_variant_from_original(image_path, pose_description, scene_cont
         
         logging.info(f"Task {index} submitted with ID: {task_id}")
         
-        # Poll for completion
-        max_attempts = config.IMAGE_GENERATION_TIMEOUT // config.IMAGE_GENERATION_CHECK_INTERVAL
-        for attempt in range(max_attempts):
-            time.sleep(config.IMAGE_GENERATION_CHECK_INTERVAL)
-            
-            logging.info(f"Checking task {index} status (attempt {attempt + 1}/{max_attempts})...")
-            
-            result = requests.get(
-                f"{base_url}v1/tasks/{task_id}",
-                headers={**common_headers, "X-ModelScope-Task-Type": "image_generation"},
-                timeout=config.API_REQUEST_TIMEOUT
-            )
-            result.raise_for_status()
-            data = result.json()
-            
-            task_status = data.get("task_status", "UNKNOWN")
-            logging.info(f"Task {index} status: {task_status}")
-            
-            if task_status == "SUCCEED":
-                output_images = data.get("output_images", [])
-                if not output_images:
-                    logging.error(f"No output images in response: {data}")
-                    return None
-                
-                image_url = output_images[0]
-                logging.info(f"Downloading generated image from: {image_url}")
-                
-                img_response = requests.get(image_url, timeout=config.API_REQUEST_TIMEOUT)
-                img_response.raise_for_status()
-                image = Image.open(BytesIO(img_response.content))
-                
-                # 添加构图线（三分法/九宫格）
-                # 使用粉色半透明线条，宽度2像素
-                image_with_lines = add_composition_lines(
-                    image, 
-                    line_type='rule_of_thirds',  # 三分法构图线
-                    line_color=(255, 36, 66, 180),  # 粉色半透明 (#FF2442 with alpha)
-                    line_width=2
-                )
-                
-                filename = f"pose_variant_{index}_{int(time.time())}.jpg"
-                filepath = os.path.join(app.config['RESULT_FOLDER'], filename)
-                if image_with_lines.mode != 'RGB':
-                    image_with_lines = image_with_lines.convert('RGB')
-                image_with_lines.save(filepath, quality=90)
-                
-                logging.info(f"Successfully generated pose variant {index} with composition lines: {filename}")
-                return filename
-                
-            elif task_status == "FAILED":
-                error_msg = data.get("error", "Unknown error")
-                logging.error(f"Task {index} failed: {error_msg}")
-                return None
-            elif task_status in ["PENDING", "RUNNING"]:
-                continue
-            else:
-                logging.error(f"Unexpected task status: {task_status}")
-                continue
-        
-        logging.error(f"Task {index} timed out after {max_attempts} attempts")
-        return None
+        # Poll for completion - 任务只能在提交它的上游上查询
+        with image_router.hold(endpoint):
+            filename = _poll_image_task(endpoint, task_id, index)
+        return filename
         
     except requests.exceptions.HTTPError as e:
         logging.error(f"HTTP Error for pose variant {index}: {str(e)}")
@@ -314,10 +263,127 @@ def generate_pose_variant_from_original(image_path, pose_description, scene_cont
         return None
 
 
+@tracing.traced
+def _poll_image_task(endpoint, task_id, index):
+    """Poll an async image generation task on its upstream and save the result"""
+    max_attempts = config.IMAGE_GENERATION_TIMEOUT // config.IMAGE_GENERATION_CHECK_INTERVAL
+    for attempt in range(max_attempts):
+        with tracing.span('image.poll_wait', index=index):
+            time.sleep(config.IMAGE_GENERATION_CHECK_INTERVAL)
+        
+        # 轮询日志走 DEBUG 级别并按调用点限流，参数延迟格式化
+        logging.debug("Checking task %s status (attempt %d/%d)...", index, attempt + 1, max_attempts)
+        
+        with tracing.span('image.poll', index=index, attempt=attempt + 1):
+            result, _ = image_router.request(
+                "GET",
+                f"v1/tasks/{task_id}",
+                headers={"X-ModelScope-Task-Type": "image_generation"},
+                endpoint=endpoint
+            )
+        result.raise_for_status()
+        data = result.json()
+        
+        task_status = data.get("task_status", "UNKNOWN")
+        logging.debug("Task %s status: %s", index, task_status)
+        
+        if task_status == "SUCCEED":
+            output_images = data.get("output_images", [])
+            if not output_images:
+                logging.error(f"No output images in response: {data}")
+                return None
+            
+            image_url = output_images[0]
+            logging.info(f"Downloading generated image from: {image_url}")
+            
+            with tracing.span('image.download', index=index):
+                img_response = requests.get(image_url, timeout=config.API_REQUEST_TIMEOUT)
+                img_response.raise_for_status()
+                image = Image.open(BytesIO(img_response.content))
+            
+            # 添加构图线（三分法/九宫格）
+            # 使用粉色半透明线条，宽度2像素
+            image_with_lines = add_composition_lines(
+                image, 
+                line_type='rule_of_thirds',  # 三分法构图线
+                line_color=(255, 36, 66, 180),  # 粉色半透明 (#FF2442 with alpha)
+                line_width=2
+            )
+            
+            filename = f"pose_variant_{index}_{int(time.time())}.jpg"
+            filepath = os.path.join(app.config['RESULT_FOLDER'], filename)
+            with tracing.span('image.save', index=index):
+                if image_with_lines.mode != 'RGB':
+                    image_with_lines = image_with_lines.convert('RGB')
+                image_with_lines.save(filepath, quality=90)
+            
+            logging.info(f"Successfully generated pose variant {index} with composition lines: {filename}")
+            return filename
+            
+        elif task_status == "FAILED":
+            error_msg = data.get("error", "Unknown error")
+            logging.error(f"Task {index} failed: {error_msg}")
+            return None
+        elif task_status in ["PENDING", "RUNNING"]:
+            continue
+        else:
+            logging.error(f"Unexpected task status: {task_status}")
+            continue
+    
+    logging.error(f"Task {index} timed out after {max_attempts} attempts")
+    return None
+
+
+
+
+def _is_admin():
+    token = request.headers.get('X-Admin-Token', '')
+    return bool(config.ADMIN_TOKEN) and hmac.compare_digest(token.encode(), config.ADMIN_TOKEN.encode())
+
+
+@app.before_request
+def assign_request_id():
+    log_config.bind_request_id(request.headers.get('X-Request-ID'))
+
+
+@app.before_request
+def start_request_trace():
+    if not config.TRACING_ENABLED:
+        return
+    if not request.path.startswith('/api/') or request.path.startswith('/api/admin/'):
+        return
+    # 管理员可通过 X-Profile 请求头强制对单个请求做栈采样
+    force_profile = bool(request.headers.get('X-Profile')) and _is_admin()
+    tracing.start_trace(f"{request.method} {request.path}", log_config.current_request_id(), force_profile)
+
+
+@app.after_request
+def expose_request_id(response):
+    response.headers['X-Request-ID'] = log_config.current_request_id()
+    trace_id = tracing.current_trace_id()
+    if trace_id is not None:
+        response.headers['X-Trace-ID'] = trace_id
+        tracing.annotate(status=response.status_code)
+    return response
+
+
+@app.teardown_request
+def clear_request_id(exc):
+    tracing.finish_trace()
+    log_config.clear_request_id()
+
+
+# 首页不含模板变量，启动时渲染一次并预压缩，之后只做编码协商与ETag校验
+index_page = None
+if config.STATIC_PAGE_ENABLED and not config.DEBUG:
+    with app.app_context():
+        index_page = PrecompressedPage(render_template('index.html'))
 
 
 @app.route('/')
 def index():
+    if index_page is not None:
+        return index_page.response(request)
     return render_template('index.html')
 
 
@@ -339,7 +405,7 @@ def plan_poses():
 
     if not image_filename:
         return jsonify({'error': '请先上传图片'}), 400
-    if not config.AI_MODELSCOPE_API_KEY or not config.IMAGE_MODELSCOPE_API_KEY:
+    if not vision_router.endpoints or not image_router.endpoints:
         return jsonify({'error': '缺少API密钥，请配置AI与图片生成服务密钥'}), 500
 
     image_path = os.path.join(app.config['UPLOAD_FOLDER'], image_filename)
@@ -381,7 +447,7 @@ def generate_poses():
     
     if not image_filename:
         return jsonify({'error': '请先上传图片'}), 400
-    if not config.AI_MODELSCOPE_API_KEY or not config.IMAGE_MODELSCOPE_API_KEY:
+    if not vision_router.endpoints or not image_router.endpoints:
         return jsonify({'error': '缺少API密钥，请配置AI与图片生成服务密钥'}), 500
     
     image_path = os.path.join(app.config['UPLOAD_FOLDER'], image_filename)
@@ -446,7 +512,7 @@ def generate_pose_image():
 
     if not image_filename or not pose_description:
         return jsonify({'error': '缺少必要参数'}), 400
-    if not config.IMAGE_MODELSCOPE_API_KEY:
+    if not image_router.endpoints:
         return jsonify({'error': '缺少图片生成服务密钥'}), 500
 
     image_path = os.path.join(app.config['UPLOAD_FOLDER'], image_filename)
@@ -470,37 +536,27 @@ def generate_pose_image():
 @app.route('/api/upload', methods=['POST'])
 def upload():
     """Simple upload endpoint that returns the filename"""
-    if 'image' not in request.files:
-        return jsonify({'error': '没有上传图片'}), 400
-    
-    file = request.files['image']
-    
-    if file.filename == '':
-        return jsonify({'error': '未选择文件'}), 400
-    
-    if not allowed_file(file.filename):
-        return jsonify({'error': '不支持的文件格式'}), 400
-    
+    # 直接解析请求流：文件头不合格时立即拒绝，合格的数据边收边写入磁盘
     try:
-        filename = secure_filename(file.filename)
-        timestamp = int(time.time())
-        filename = f"{timestamp}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        try:
-            Image.open(filepath).verify()
-        except Exception:
-            os.remove(filepath)
-            return jsonify({'error': '文件内容无效或已损坏'}), 400
+        filename = stream_image_upload(
+            request.stream,
+            request.content_type,
+            app.config['UPLOAD_FOLDER']
+        )
         
         return jsonify({
             'status': 'success',
             'filename': filename
         })
+    except UploadRejected as e:
+        return jsonify({'error': e.message}), e.status
+    except RequestEntityTooLarge:
+        return jsonify({'error': '文件过大'}), 413
     except Exception as e:
         return jsonify({'error': f'上传失败: {str(e)}'}), 500
 
 
+@tracing.traced
 def get_diverse_poses_for_scene(scene_context, gender='female'):
     """Use AI to intelligently generate diverse poses based on scene analysis"""
     try:
@@ -514,14 +570,8 @@ def get_diverse_poses_for_scene(scene_context, gender='female'):
         )
 
         # Use direct API call to avoid OpenAI client library version issues
-        api_url = f"{config.AI_MODELSCOPE_BASE_URL}/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {config.AI_MODELSCOPE_API_KEY}",
-            "Content-Type": "application/json",
-        }
-        
+        # 'model' 由上游路由器按所选上游填充
         payload = {
-            "model": config.VISION_MODEL,
             "messages": [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": prompt},
@@ -530,12 +580,8 @@ def get_diverse_poses_for_scene(scene_context, gender='female'):
             "max_tokens": 1000,
         }
         
-        response = requests.post(
-            api_url,
-            headers=headers,
-            json=payload,
-            timeout=config.API_REQUEST_TIMEOUT
-        )
+        # 对话补全不在上游创建任务，可安全地在其他上游上重试
+        response, _ = vision_router.request("POST", "chat/completions", payload=payload, idempotent=True)
         response.raise_for_status()
         
         result = response.json()
@@ -574,18 +620,71 @@ def get_diverse_poses_for_scene(scene_context, gender='female'):
 
 
 
+@app.route('/api/admin/traces')
+def list_traces():
+    if not _is_admin():
+        return jsonify({'error': '无权访问'}), 403
+    return jsonify({
+        'traces': tracing.recent_traces(),
+        'profiling': {'sample_rate': tracing.get_sample_rate()},
+        'logging': log_config.get_log_stats(),
+    })
+
+
+@app.route('/api/admin/traces/<trace_id>')
+def export_trace(trace_id):
+    """Export one trace: ?format=json (default) | chrome | collapsed (flame graph input)"""
+    if not _is_admin():
+        return jsonify({'error': '无权访问'}), 403
+    trace = tracing.get_trace(trace_id)
+    if trace is None:
+        return jsonify({'error': '追踪记录不存在'}), 404
+
+    export_format = request.args.get('format', 'json')
+    if export_format == 'chrome':
+        return jsonify(trace.to_chrome())
+    if export_format == 'collapsed':
+        if trace.profile is None:
+            return jsonify({'error': '该请求未做性能采样'}), 404
+        return app.response_class(trace.profile, mimetype='text/plain')
+    return jsonify(trace.to_json())
+
+
+@app.route('/api/admin/profiling', methods=['POST'])
+def set_profiling():
+    """Set the fraction of requests to profile (shared by all workers)"""
+    if not _is_admin():
+        return jsonify({'error': '无权访问'}), 403
+    data = request.get_json(silent=True) or {}
+    try:
+        sample_rate = float(data.get('sample_rate', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'sample_rate 必须是0到1之间的数字'}), 400
+    if not math.isfinite(sample_rate):
+        return jsonify({'error': 'sample_rate 必须是0到1之间的数字'}), 400
+    sample_rate = min(max(sample_rate, 0.0), 1.0)
+    tracing.set_sample_rate(sample_rate)
+    return jsonify({'status': 'success', 'profiling': {'sample_rate': sample_rate}})
+
+
+def _send_media(folder, filename):
+    response = send_from_directory(folder, filename)
+    # 文件名可能在同一秒内被复用，且内容是用户照片：只允许浏览器私有缓存，每次用ETag校验
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return _send_media(app.config['UPLOAD_FOLDER'], filename)
 
 
 @app.route('/results/<filename>')
 def result_file(filename):
-    return send_from_directory(app.config['RESULT_FOLDER'], filename)
+    return _send_media(app.config['RESULT_FOLDER'], filename)
 
 
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
     print("\n" + "="*60)
     print("🎨 PoseMind - AI Photography Pose Recommendation System")
     print("="*60)
@@ -595,9 +694,11 @@ if __name__ == '__main__':
     print(f"\n🤖 AI Model Configuration:")
     print(f"   Vision Model: {config.VISION_MODEL}")
     print(f"   API Base URL: {config.AI_MODELSCOPE_BASE_URL}")
+    print(f"   Upstreams: {len(vision_router.endpoints)}")
     print(f"\n🎨 Image Generation Model Configuration:")
     print(f"   Generation Model: {config.IMAGE_GENERATION_MODEL}")
     print(f"   API Base URL: {config.IMAGE_MODELSCOPE_BASE_URL}")
+    print(f"   Upstreams: {len(image_router.endpoints)}")
     print(f"\n💡 Open your browser and visit: http://localhost:{config.PORT}")
     print("⏹  Press Ctrl+C to stop the server\n")
     print("="*60 + "\n")
@@ -2,6 +2,7 @@
 Configuration file for PoseMind application
 """
 
+import json
 import os
 import secrets
 
@@ -11,8 +12,15 @@ UPLOAD_FOLDER = 'uploads'
 RESULT_FOLDER = 'results'
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+# 解码前的像素上限，防止解压炸弹（同时作用于上传校验与 PIL 解码）
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', 50_000_000))
+UPLOAD_CHUNK_SIZE = 64 * 1024  # 流式读取上传请求体的块大小
+UPLOAD_HEADER_MAX_BYTES = 256 * 1024  # 解析图片尺寸最多缓存的文件头字节数
+UPLOAD_MAX_PARTS = 10
 
 DEBUG = os.getenv('DEBUG', 'false').lower() in ('1', 'true', 'yes', 'on')
+# 启动时预渲染并预压缩首页（DEBUG 模式下仍每次渲染模板，便于开发）
+STATIC_PAGE_ENABLED = os.getenv('STATIC_PAGE_ENABLED', 'true').lower() in ('1', 'true', 'yes', 'on')
 HOST = '0.0.0.0'
 SECRET_KEY = os.getenv('SECRET_KEY') or secrets.token_hex(32)
 SESSION_COOKIE_HTTPONLY = True
@@ -54,10 +62,74 @@ IMAGE_MODELSCOPE_BASE_URL = os.getenv('IMAGE_MODELSCOPE_BASE_URL', 'https://api-
 VISION_MODEL = os.getenv('VISION_MODEL', 'Qwen/Qwen3-VL-235B-A22B-Instruct')
 IMAGE_GENERATION_MODEL = os.getenv('IMAGE_GENERATION_MODEL', 'Qwen/Qwen-Image')
 
+
+def _load_upstreams(env_name, default_base_url, default_api_key, default_model):
+    """
+    读取上游池配置：环境变量为JSON数组，每项必须包含 api_key，
+    base_url / model 缺省时使用单key配置；未设置时退化为单个上游
+    """
+    raw = os.getenv(env_name, '').strip()
+    if not raw:
+        if not default_api_key:
+            return []
+        return [{'base_url': default_base_url, 'api_key': default_api_key, 'model': default_model}]
+
+    try:
+        entries = json.loads(raw)
+    except ValueError as e:
+        raise ValueError(f"{env_name} is not valid JSON: {e}") from None
+    if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+        raise ValueError(f"{env_name} must be a JSON array of objects")
+
+    upstreams = []
+    seen_keys = set()
+    for i, entry in enumerate(entries):
+        # 冷却状态按条目记录，每个条目必须有独立的key，才能正确跟踪各key的配额
+        api_key = entry.get('api_key')
+        if not api_key or not isinstance(api_key, str):
+            raise ValueError(f"{env_name}[{i}] is missing 'api_key'")
+        if api_key in seen_keys:
+            raise ValueError(f"{env_name}[{i}] reuses an api_key already in the pool")
+        seen_keys.add(api_key)
+        upstreams.append({
+            'base_url': entry.get('base_url') or default_base_url,
+            'api_key': api_key,
+            'model': entry.get('model') or default_model,
+        })
+    return upstreams
+
+
+# Upstream Pool Configuration - 多key/多端点，用于突破单key限流
+# 例: AI_MODELSCOPE_UPSTREAMS='[{"api_key": "key-a"}, {"base_url": "https://...", "api_key": "key-b", "model": "..."}]'
+AI_UPSTREAMS = _load_upstreams('AI_MODELSCOPE_UPSTREAMS', AI_MODELSCOPE_BASE_URL, AI_MODELSCOPE_API_KEY, VISION_MODEL)
+IMAGE_UPSTREAMS = _load_upstreams('IMAGE_MODELSCOPE_UPSTREAMS', IMAGE_MODELSCOPE_BASE_URL, IMAGE_MODELSCOPE_API_KEY, IMAGE_GENERATION_MODEL)
+UPSTREAM_EWMA_ALPHA = float(os.getenv('UPSTREAM_EWMA_ALPHA', 0.3))
+UPSTREAM_ERROR_PENALTY = float(os.getenv('UPSTREAM_ERROR_PENALTY', 10))
+UPSTREAM_QUOTA_COOLDOWN = int(os.getenv('UPSTREAM_QUOTA_COOLDOWN', 60))  # seconds, 429后的初始冷却
+UPSTREAM_MAX_COOLDOWN = int(os.getenv('UPSTREAM_MAX_COOLDOWN', 3600))  # seconds
+
+# Logging Configuration - 日志经队列由后台线程写出
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()  # json | text
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))  # 队列满时丢弃新日志而不是阻塞请求
+LOG_DEBUG_RATE = float(os.getenv('LOG_DEBUG_RATE', 1.0))  # 每个调用点每秒允许的DEBUG日志条数
+LOG_DEBUG_BURST = int(os.getenv('LOG_DEBUG_BURST', 5))
+
+# Tracing / Profiling Configuration
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'true').lower() in ('1', 'true', 'yes', 'on')
+TRACE_DIR = os.getenv('TRACE_DIR', 'traces')  # 追踪记录与采样设置目录，所有worker共享
+TRACE_BUFFER_SIZE = int(os.getenv('TRACE_BUFFER_SIZE', 200))  # 保留的最近请求追踪数
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))  # 0-1，按比例对请求做栈采样
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.01))  # seconds, 栈采样间隔
+# 管理接口令牌（请求头 X-Admin-Token），未设置时管理接口不可用
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+
 # Timeout Configuration - 优先从环境变量读取
 IMAGE_GENERATION_TIMEOUT = int(os.getenv('IMAGE_GENERATION_TIMEOUT', 150))  # seconds (4张图约2.5分钟)
 IMAGE_GENERATION_CHECK_INTERVAL = int(os.getenv('IMAGE_GENERATION_CHECK_INTERVAL', 5))  # seconds
 API_REQUEST_TIMEOUT = int(os.getenv('API_REQUEST_TIMEOUT', 30))  # seconds
+# 单次上游调用（含故障转移重试）的总时限
+UPSTREAM_FAILOVER_DEADLINE = int(os.getenv('UPSTREAM_FAILOVER_DEADLINE', API_REQUEST_TIMEOUT * 2))  # seconds
 
 # Prompt Configuration
 POSE_CATEGORIES = ['经典', '动态', '坐姿', '情感', '艺术', '互动', '时尚', '倚靠']
@@ -44,3 +44,9 @@ preload_app = True
 # 守护进程（生产环境建议使用supervisor管理）
 daemon = False
 
+
+def post_fork(server, worker):
+    # preload_app 时主进程的日志后台线程不会被 fork 继承，在每个 worker 中重新启动
+    import log_config
+    log_config.setup_logging()
+
@@ -0,0 +1,182 @@
+"""
+Logging setup for PoseMind
+日志经队列交给后台线程写出，请求线程只负责入队；输出为带请求ID的结构化JSON
+"""
+
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+
+import config
+
+
+_request_id = contextvars.ContextVar('request_id', default='-')
+# 客户端提供的请求ID只接受这些字符，其他情况由服务端生成
+_REQUEST_ID_RE = re.compile(r'[A-Za-z0-9._-]{1,64}')
+
+_state = {'pid': None, 'handler': None, 'listener': None}
+_stats_lock = threading.Lock()
+_stats = {'enqueued': 0, 'dropped': 0, 'sampled_out': 0, 'enqueue_seconds': 0.0}
+
+
+def bind_request_id(request_id=None):
+    """Bind a correlation id to the current request context and return it; invalid client ids are replaced"""
+    if not request_id or not _REQUEST_ID_RE.fullmatch(request_id):
+        request_id = uuid.uuid4().hex[:16]
+    _request_id.set(request_id)
+    return request_id
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+def clear_request_id():
+    _request_id.set('-')
+
+
+def get_log_stats():
+    """Counters for the logging hot path (records enqueued/dropped, time spent enqueuing)"""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _count(key, value=1):
+    with _stats_lock:
+        _stats[key] += value
+
+
+class RequestIdFilter(logging.Filter):
+    """Attach the current correlation id; runs in the calling thread before the record is queued"""
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        return True
+
+
+class DebugRateLimitFilter(logging.Filter):
+    """Token bucket per call site for DEBUG records, so tight polling loops cannot flood the log"""
+
+    def __init__(self, rate, burst):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+        if not allowed:
+            _count('sampled_out')
+        return allowed
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'request_id': getattr(record, 'request_id', '-'),
+            'msg': record.getMessage(),
+        }
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _AsyncQueueHandler(QueueHandler):
+    """Non-blocking enqueue: records are dropped (and counted) rather than stalling a request when the queue is full"""
+
+    def prepare(self, record):
+        # 在请求线程中完成消息插值与异常格式化，后台线程只负责序列化与写出
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def emit(self, record):
+        started = time.perf_counter()
+        try:
+            self.enqueue(self.prepare(record))
+            _count('enqueued')
+        except queue.Full:
+            _count('dropped')
+        except Exception:
+            self.handleError(record)
+        finally:
+            _count('enqueue_seconds', time.perf_counter() - started)
+
+    def enqueue(self, record):
+        self.queue.put_nowait(record)
+
+
+def _make_formatter():
+    if config.LOG_FORMAT == 'json':
+        return JsonFormatter()
+    return logging.Formatter('%(asctime)s %(levelname)s [%(request_id)s] %(message)s')
+
+
+def setup_logging():
+    """
+    安装队列日志处理器并启动后台写线程
+
+    可重复调用：在 gunicorn preload 后 fork 出的 worker 中再次调用时，
+    会丢弃从主进程继承的队列并为当前进程重新启动后台线程
+    """
+    pid = os.getpid()
+    if _state['pid'] == pid:
+        return
+
+    root = logging.getLogger()
+    if _state['handler'] is not None:
+        # 继承自父进程的监听线程在子进程中不存在，直接替换
+        root.removeHandler(_state['handler'])
+
+    log_queue = queue.Queue(maxsize=config.LOG_QUEUE_SIZE)
+    handler = _AsyncQueueHandler(log_queue)
+    handler.addFilter(RequestIdFilter())
+    handler.addFilter(DebugRateLimitFilter(config.LOG_DEBUG_RATE, config.LOG_DEBUG_BURST))
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(_make_formatter())
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+
+    root.addHandler(handler)
+    root.setLevel(config.LOG_LEVEL)
+
+    if _state['pid'] is None:
+        atexit.register(_stop_listener)
+    _state.update(pid=pid, handler=handler, listener=listener)
+
+
+def _stop_listener():
+    # 只停止本进程启动的监听线程，退出前写完队列中剩余的日志
+    if _state['pid'] == os.getpid() and _state['listener'] is not None:
+        _state['listener'].stop()
@@ -0,0 +1,53 @@
+"""
+Precompressed page delivery for PoseMind
+启动时渲染单页前端并预压缩为 gzip/brotli，请求时按 Accept-Encoding 直接返回对应字节
+"""
+
+import gzip
+import hashlib
+
+from flask import Response
+
+try:
+    import brotli
+except ImportError:  # brotli 为可选依赖，缺失时只提供 gzip
+    brotli = None
+
+
+class PrecompressedPage:
+    """A rendered page held in memory as identity / gzip / br variants with content-hashed ETags"""
+
+    def __init__(self, body, mimetype='text/html'):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(body).hexdigest()[:16]
+        self.variants = {'identity': body}
+
+        # mtime=0 让压缩结果在多个 worker 间保持一致
+        compressed = gzip.compress(body, compresslevel=9, mtime=0)
+        if len(compressed) < len(body):
+            self.variants['gzip'] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(body, quality=11)
+            if len(compressed) < len(body):
+                self.variants['br'] = compressed
+
+    def choose_encoding(self, accept_encodings):
+        """Pick the smallest variant the client accepts"""
+        candidates = [
+            encoding for encoding in self.variants
+            if encoding == 'identity' or accept_encodings[encoding] > 0
+        ]
+        return min(candidates, key=lambda encoding: len(self.variants[encoding]))
+
+    def response(self, request, cache_control='no-cache'):
+        encoding = self.choose_encoding(request.accept_encodings)
+        response = Response(self.variants[encoding], mimetype=self.mimetype)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = cache_control
+        # 每种编码是不同的表示，使用不同的强ETag
+        response.set_etag(f"{self.digest}-{encoding}")
+        return response.make_conditional(request)
@@ -0,0 +1,303 @@
+"""
+Request tracing and sampling profiler for PoseMind
+按请求记录各阶段耗时（span），可导出为JSON或Chrome trace格式；按比例对请求做栈采样，输出可直接用于火焰图的折叠栈
+追踪记录与采样比例保存在 config.TRACE_DIR 下，所有 gunicorn worker 共享
+"""
+
+import collections
+import contextvars
+import functools
+import json
+import logging
+import os
+import re
+import random
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import config
+
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+_TRACE_ID_RE = re.compile(r'[0-9a-f]{32}')
+_PROFILING_FILE = 'profiling.json'
+
+# 采样比例的进程内缓存：最多每秒检查一次共享文件是否被管理接口修改
+_profiling_cache = {'checked': 0.0, 'mtime': None, 'sample_rate': config.PROFILE_SAMPLE_RATE}
+_profiling_lock = threading.Lock()
+
+
+class Trace:
+    """Spans recorded for a single request"""
+
+    def __init__(self, trace_id, name):
+        self.trace_id = trace_id
+        self.name = name
+        self.pid = os.getpid()
+        self.tid = threading.get_ident()
+        self.start = time.time()
+        self.duration = None
+        self.spans = []
+        self.attrs = {}
+        self.profile = None
+
+    def add_span(self, name, start, duration, attrs):
+        self.spans.append({
+            'name': name,
+            'start': start,
+            'duration': duration,
+            'tid': threading.get_ident(),
+            'attrs': attrs,
+        })
+
+    def summary(self):
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'spans': len(self.spans),
+            'profiled': self.profile is not None,
+            **self.attrs,
+        }
+
+    def to_json(self):
+        return {**self.summary(), 'spans': self.spans}
+
+    def dump(self):
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'pid': self.pid,
+            'tid': self.tid,
+            'start': self.start,
+            'duration': self.duration,
+            'attrs': self.attrs,
+            'spans': self.spans,
+            'profile': self.profile,
+        }
+
+    @classmethod
+    def load(cls, data):
+        trace = cls(data['trace_id'], data['name'])
+        for key in ('pid', 'tid', 'start', 'duration', 'attrs', 'spans', 'profile'):
+            setattr(trace, key, data[key])
+        return trace
+
+    def to_chrome(self):
+        """Chrome trace event format (chrome://tracing, Perfetto, speedscope)"""
+        events = [{
+            'name': self.name,
+            'ph': 'X',
+            'ts': int(self.start * 1e6),
+            'dur': int((self.duration or 0) * 1e6),
+            'pid': self.pid,
+            'tid': self.tid,
+            'args': {'trace_id': self.trace_id, **self.attrs},
+        }]
+        for span in self.spans:
+            events.append({
+                'name': span['name'],
+                'ph': 'X',
+                'ts': int(span['start'] * 1e6),
+                'dur': int(span['duration'] * 1e6),
+                'pid': self.pid,
+                'tid': span['tid'],
+                'args': span['attrs'],
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+class StackSampler:
+    """Statistical profiler: periodically samples one thread's stack and counts collapsed stacks"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.counts[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        """Brendan Gregg collapsed-stack text, usable by flamegraph.pl / speedscope"""
+        return '\n'.join(f"{stack} {count}" for stack, count in self.counts.most_common())
+
+
+def start_trace(name, request_id=None, force_profile=False):
+    """
+    Begin tracing the current request; profiles it when sampled or forced
+
+    追踪ID由服务端生成，客户端可控的请求ID只作为属性保存，避免覆盖其他请求的追踪
+    """
+    trace = Trace(uuid.uuid4().hex, name)
+    if request_id is not None:
+        trace.attrs['request_id'] = request_id
+    sampler = None
+    if force_profile or random.random() < get_sample_rate():
+        sampler = StackSampler(threading.get_ident(), config.PROFILE_INTERVAL)
+        sampler.start()
+    _current_trace.set((trace, sampler))
+    return trace
+
+
+def finish_trace():
+    """Close the current request's trace and write it to the shared trace directory"""
+    current = _current_trace.get()
+    if current is None:
+        return None
+    _current_trace.set(None)
+    trace, sampler = current
+    trace.duration = time.time() - trace.start
+    if sampler is not None:
+        sampler.stop()
+        trace.profile = sampler.collapsed()
+
+    try:
+        _write_json(os.path.join(config.TRACE_DIR, f"{trace.trace_id}.json"), trace.dump())
+        _prune_traces()
+    except OSError as e:
+        logging.warning(f"Failed to save trace {trace.trace_id}: {str(e)}")
+    return trace
+
+
+def current_trace_id():
+    current = _current_trace.get()
+    return current[0].trace_id if current is not None else None
+
+
+def annotate(**attrs):
+    """Attach attributes (e.g. response status) to the current request's trace"""
+    current = _current_trace.get()
+    if current is not None:
+        current[0].attrs.update(attrs)
+
+
+def get_trace(trace_id):
+    if not _TRACE_ID_RE.fullmatch(trace_id):
+        return None
+    try:
+        with open(os.path.join(config.TRACE_DIR, f"{trace_id}.json"), encoding='utf-8') as f:
+            return Trace.load(json.load(f))
+    except (OSError, ValueError):
+        return None
+
+
+def recent_traces():
+    """Summaries of the saved traces from all workers, newest first"""
+    summaries = []
+    for path in reversed(_trace_files()):
+        try:
+            with open(path, encoding='utf-8') as f:
+                summaries.append(Trace.load(json.load(f)).summary())
+        except (OSError, ValueError):
+            # 可能刚被其他 worker 清理
+            continue
+    return summaries
+
+
+def get_sample_rate():
+    """Profiling sample rate shared by all workers (falls back to config.PROFILE_SAMPLE_RATE)"""
+    now = time.monotonic()
+    with _profiling_lock:
+        if now - _profiling_cache['checked'] < 1.0:
+            return _profiling_cache['sample_rate']
+        _profiling_cache['checked'] = now
+        path = os.path.join(config.TRACE_DIR, _PROFILING_FILE)
+        try:
+            mtime = os.stat(path).st_mtime
+            if mtime != _profiling_cache['mtime']:
+                with open(path, encoding='utf-8') as f:
+                    _profiling_cache['sample_rate'] = float(json.load(f)['sample_rate'])
+                _profiling_cache['mtime'] = mtime
+        except FileNotFoundError:
+            _profiling_cache.update(mtime=None, sample_rate=config.PROFILE_SAMPLE_RATE)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Failed to read profiling settings: {str(e)}")
+        return _profiling_cache['sample_rate']
+
+
+def set_sample_rate(sample_rate):
+    """Persist the sample rate for all workers; each picks it up within a second"""
+    _write_json(os.path.join(config.TRACE_DIR, _PROFILING_FILE), {'sample_rate': sample_rate})
+    with _profiling_lock:
+        _profiling_cache.update(checked=0.0, mtime=None)
+
+
+def _write_json(path, data):
+    # 先写临时文件再原子替换，其他 worker 不会读到写了一半的文件
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _trace_files():
+    """Saved trace files, oldest first"""
+    paths = []
+    for entry in os.scandir(config.TRACE_DIR):
+        name, ext = os.path.splitext(entry.name)
+        if ext == '.json' and _TRACE_ID_RE.fullmatch(name):
+            try:
+                paths.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                continue
+    return [path for _, path in sorted(paths)]
+
+
+def _prune_traces():
+    paths = _trace_files()
+    for path in paths[:max(len(paths) - config.TRACE_BUFFER_SIZE, 0)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    记录一个阶段的耗时；不在追踪中的调用（如后台任务）几乎无开销
+
+    yield 出的 dict 可在阶段内补充属性（如状态码）
+    """
+    current = _current_trace.get()
+    if current is None:
+        yield attrs
+        return
+    start = time.time()
+    try:
+        yield attrs
+    finally:
+        current[0].add_span(name, start, time.time() - start, attrs)
+
+
+def traced(func):
+    """Decorator: record each call of func as a span named after the function"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
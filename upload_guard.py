@@ -0,0 +1,215 @@
+"""
+Streaming upload validation for PoseMind
+边接收边校验上传图片：首个数据块即检查文件头与尺寸，不合格的请求无需读完整个请求体
+"""
+
+import os
+import time
+from io import BytesIO
+
+from PIL import Image
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+from werkzeug.utils import secure_filename
+
+import config
+
+
+# 文件头魔数 -> PIL格式名
+MAGIC_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+]
+
+EXTENSION_FORMATS = {
+    'png': 'PNG',
+    'jpg': 'JPEG',
+    'jpeg': 'JPEG',
+    'gif': 'GIF',
+    'webp': 'WEBP',
+}
+
+
+class UploadRejected(Exception):
+    """Raised when an upload fails validation; carries the HTTP status to return"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in config.ALLOWED_EXTENSIONS
+
+
+def sniff_image_format(head):
+    """Return the PIL format name from the magic bytes, or None if unknown"""
+    for signature, image_format in MAGIC_SIGNATURES:
+        if head.startswith(signature):
+            return image_format
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+
+def read_webp_size(head):
+    """
+    从 RIFF 容器的首个块头读取 WebP 尺寸（前30字节内即可确定）
+
+    PIL 需要完整文件才能打开 WebP，无法用于只收到部分数据的校验
+
+    Returns:
+        (width, height)；数据不足时返回 None
+    """
+    if len(head) < 30:
+        return None
+    chunk = head[12:16]
+    if chunk == b'VP8 ':
+        # 有损：3字节帧标记 + 起始码 9d 01 2a，之后是14位宽高
+        if head[23:26] != b'\x9d\x01\x2a':
+            raise UploadRejected('文件内容无效或已损坏')
+        width = int.from_bytes(head[26:28], 'little') & 0x3fff
+        height = int.from_bytes(head[28:30], 'little') & 0x3fff
+    elif chunk == b'VP8L':
+        # 无损：签名 0x2f，之后14位(宽-1)与14位(高-1)
+        if head[20] != 0x2f:
+            raise UploadRejected('文件内容无效或已损坏')
+        bits = int.from_bytes(head[21:25], 'little')
+        width = (bits & 0x3fff) + 1
+        height = ((bits >> 14) & 0x3fff) + 1
+    elif chunk == b'VP8X':
+        # 扩展格式：4字节标志后是24位(画布宽-1)与24位(画布高-1)
+        width = int.from_bytes(head[24:27], 'little') + 1
+        height = int.from_bytes(head[27:30], 'little') + 1
+    else:
+        raise UploadRejected('文件内容无效或已损坏')
+    return width, height
+
+
+def read_image_header(head):
+    """
+    从已接收的文件头部解析格式与尺寸
+
+    Returns:
+        (format, width, height)；头部数据还不够解析尺寸时返回 None
+
+    Raises:
+        UploadRejected: 文件类型不支持或像素数超限
+    """
+    image_format = sniff_image_format(head[:12])
+    if len(head) >= 12 and image_format is None:
+        raise UploadRejected('文件内容无效或已损坏')
+    allowed_formats = {EXTENSION_FORMATS[ext] for ext in config.ALLOWED_EXTENSIONS if ext in EXTENSION_FORMATS}
+    if image_format is not None and image_format not in allowed_formats:
+        raise UploadRejected('不支持的文件格式')
+
+    if image_format == 'WEBP':
+        size = read_webp_size(head)
+        if size is None:
+            return None
+        width, height = size
+    else:
+        try:
+            # Image.open 只解析文件头，不解码像素
+            with Image.open(BytesIO(head)) as img:
+                width, height = img.size
+        except Image.DecompressionBombError:
+            raise UploadRejected('图片像素过大', 413)
+        except Exception:
+            return None
+
+    if width * height > config.MAX_IMAGE_PIXELS:
+        raise UploadRejected('图片像素过大', 413)
+    return image_format, width, height
+
+
+def _chunk_iter(stream):
+    while True:
+        chunk = stream.read(config.UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+    yield None
+
+
+def stream_image_upload(stream, content_type, folder, field_name='image'):
+    """
+    流式解析 multipart 请求体，校验通过后直接写入存储目录
+
+    Args:
+        stream: 请求体输入流（request.stream）
+        content_type: 请求的 Content-Type 头
+        folder: 保存目录
+        field_name: 图片表单字段名
+
+    Returns:
+        保存后的文件名
+
+    Raises:
+        UploadRejected: 校验失败（已写入的部分文件会被删除）
+    """
+    mimetype, options = parse_options_header(content_type or '')
+    boundary = options.get('boundary')
+    if mimetype != 'multipart/form-data' or not boundary:
+        raise UploadRejected('没有上传图片')
+
+    decoder = MultipartDecoder(boundary.encode('latin-1'), max_parts=config.UPLOAD_MAX_PARTS)
+    capturing = False
+    head = bytearray()
+    filename = None
+    filepath = None
+    out = None
+
+    try:
+        for chunk in _chunk_iter(stream):
+            decoder.receive_data(chunk)
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, (Field, File)):
+                    capturing = isinstance(event, File) and event.name == field_name
+                    if capturing:
+                        if not event.filename:
+                            raise UploadRejected('未选择文件')
+                        if not allowed_file(event.filename):
+                            raise UploadRejected('不支持的文件格式')
+                        filename = f"{int(time.time())}_{secure_filename(event.filename)}"
+                elif isinstance(event, Data) and capturing:
+                    if out is None:
+                        # 文件头阶段：只在内存中缓存，尺寸确认前不落盘
+                        head.extend(event.data)
+                        if read_image_header(bytes(head)) is not None:
+                            filepath = os.path.join(folder, filename)
+                            out = open(filepath, 'wb')
+                            out.write(head)
+                        elif len(head) > config.UPLOAD_HEADER_MAX_BYTES or not event.more_data:
+                            raise UploadRejected('文件内容无效或已损坏')
+                    else:
+                        out.write(event.data)
+
+                    if not event.more_data:
+                        out.close()
+                        Image.open(filepath).verify()
+                        return filename
+                event = decoder.next_event()
+    except (UploadRejected, HTTPException):
+        _discard(out, filepath)
+        raise
+    except Exception:
+        _discard(out, filepath)
+        if filepath is not None:
+            raise UploadRejected('文件内容无效或已损坏')
+        raise
+
+    _discard(out, filepath)
+    raise UploadRejected('没有上传图片' if filename is None else '文件内容无效或已损坏')
+
+
+def _discard(out, filepath):
+    if out is not None and not out.closed:
+        out.close()
+    if filepath is not None and os.path.exists(filepath):
+        os.remove(filepath)
@@ -0,0 +1,248 @@
+"""
+Upstream router for PoseMind
+在多个 (base_url, key, model) 上游之间做延迟感知的负载均衡与故障转移
+"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+import config
+import tracing
+
+
+# 上游明确拒绝了请求（限流或key无效），换一个上游重试不会产生重复任务
+FAILOVER_STATUS_CODES = {401, 403, 429}
+# 上游可能已经处理了请求，只有可安全重复的调用（idempotent=True）才换上游重试
+RETRYABLE_STATUS_CODES = {500, 502, 503, 504}
+
+
+class UpstreamEndpoint:
+    """A single upstream entry with its observed latency, error rate and quota state"""
+
+    def __init__(self, base_url, api_key, model):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.ewma_latency = 0.0
+        self.ewma_error = 0.0
+        self.outstanding = 0
+        self.cooldown_until = 0.0
+        self.consecutive_429 = 0
+
+    def url(self, path):
+        return f"{self.base_url.rstrip('/')}/{path.lstrip('/')}"
+
+    def is_available(self, now):
+        return now >= self.cooldown_until
+
+    def score(self):
+        """Lower is better: expected latency scaled by queue depth and recent errors"""
+        return (
+            (self.ewma_latency + 0.05)
+            * (self.outstanding + 1)
+            * (1 + config.UPSTREAM_ERROR_PENALTY * self.ewma_error)
+        )
+
+    def __repr__(self):
+        # 不输出 key，避免泄露到日志
+        return f"<UpstreamEndpoint {self.base_url} model={self.model}>"
+
+
+class UpstreamRouter:
+    """Pick upstreams by EWMA latency / error rate and least outstanding requests"""
+
+    def __init__(self, name, entries):
+        self.name = name
+        self.endpoints = [
+            UpstreamEndpoint(e['base_url'], e['api_key'], e['model'])
+            for e in entries
+        ]
+        self._lock = threading.Lock()
+
+    def acquire(self, exclude=()):
+        """Reserve the best endpoint, skipping excluded ones; returns None if nothing usable is left"""
+        with self._lock:
+            candidates = [ep for ep in self.endpoints if ep not in exclude]
+            if not candidates:
+                return None
+            now = time.time()
+            available = [ep for ep in candidates if ep.is_available(now)]
+            if available:
+                endpoint = min(available, key=UpstreamEndpoint.score)
+            elif not exclude:
+                # 首次选择时所有key都在冷却中：选择最早恢复的那个，而不是直接失败
+                endpoint = min(candidates, key=lambda ep: ep.cooldown_until)
+            else:
+                # 故障转移时不再尝试仍在冷却中的key
+                return None
+            endpoint.outstanding += 1
+            return endpoint
+
+    def release(self, endpoint, latency, status_code=None, error=False, retry_after=None):
+        """Return an endpoint acquired by acquire() and record the outcome"""
+        alpha = config.UPSTREAM_EWMA_ALPHA
+        failed = error or status_code in FAILOVER_STATUS_CODES or status_code in RETRYABLE_STATUS_CODES
+        with self._lock:
+            endpoint.outstanding = max(endpoint.outstanding - 1, 0)
+            # 失败（如429/401）通常很快返回，计入延迟会让刚耗尽配额的key显得更快，只计错误率
+            if not failed:
+                if endpoint.ewma_latency == 0.0:
+                    endpoint.ewma_latency = latency
+                else:
+                    endpoint.ewma_latency = alpha * latency + (1 - alpha) * endpoint.ewma_latency
+            endpoint.ewma_error = alpha * (1.0 if failed else 0.0) + (1 - alpha) * endpoint.ewma_error
+
+            now = time.time()
+            if status_code == 429:
+                # 配额耗尽：按 Retry-After 或指数退避冷却该key
+                endpoint.consecutive_429 += 1
+                cooldown = retry_after
+                if cooldown is None:
+                    cooldown = min(
+                        config.UPSTREAM_QUOTA_COOLDOWN * 2 ** (endpoint.consecutive_429 - 1),
+                        config.UPSTREAM_MAX_COOLDOWN
+                    )
+                # 只延长不缩短：新的429不能缩短 Retry-After 或 key 失效惩罚
+                endpoint.cooldown_until = max(endpoint.cooldown_until, now + cooldown)
+                logging.warning(f"[{self.name}] {endpoint!r} rate limited, cooling down for {cooldown:.0f}s")
+            elif status_code in (401, 403):
+                endpoint.cooldown_until = max(endpoint.cooldown_until, now + config.UPSTREAM_MAX_COOLDOWN)
+                logging.error(f"[{self.name}] {endpoint!r} rejected the API key ({status_code})")
+            elif not failed:
+                endpoint.consecutive_429 = 0
+
+    @contextmanager
+    def hold(self, endpoint):
+        """Count a long-running task (e.g. async image generation) as outstanding on its endpoint"""
+        with self._lock:
+            endpoint.outstanding += 1
+        try:
+            yield endpoint
+        finally:
+            with self._lock:
+                endpoint.outstanding = max(endpoint.outstanding - 1, 0)
+
+    def request(self, method, path, payload=None, headers=None, endpoint=None, timeout=None, idempotent=False):
+        """
+        发送请求，必要时在其他上游上透明重试
+
+        Args:
+            method: HTTP方法
+            path: 相对于上游 base_url 的路径
+            payload: JSON请求体，'model' 字段会被替换为所选上游的模型
+            headers: 额外请求头（Authorization 由路由器填充）
+            endpoint: 固定使用的上游（如轮询异步任务），此时不做故障转移
+            timeout: 单次请求超时，默认 config.API_REQUEST_TIMEOUT；
+                包含故障转移在内的总耗时不超过 config.UPSTREAM_FAILOVER_DEADLINE
+            idempotent: 请求可安全重复时设为True，读超时与5xx也会换上游重试；
+                默认只在连接失败、429、401/403 时切换，避免重复提交任务
+
+        Returns:
+            (response, endpoint) 元组；所有上游都失败时返回最后一个响应或抛出最后一个异常
+        """
+        if not self.endpoints:
+            raise RuntimeError(f"No upstream configured for {self.name}")
+        timeout = timeout or config.API_REQUEST_TIMEOUT
+        deadline = time.time() + config.UPSTREAM_FAILOVER_DEADLINE
+        tried = []
+        last_response = None
+        last_error = None
+
+        while True:
+            attempt_timeout = timeout
+            if tried:
+                # 故障转移受总时限约束，避免最坏情况下耗时为 N × 超时
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                attempt_timeout = min(timeout, remaining)
+            if endpoint is not None:
+                if tried:
+                    break
+                ep = endpoint
+                with self._lock:
+                    ep.outstanding += 1
+            else:
+                ep = self.acquire(exclude=tried)
+                if ep is None:
+                    break
+            tried.append(ep)
+
+            request_headers = {
+                "Authorization": f"Bearer {ep.api_key}",
+                "Content-Type": "application/json",
+                **(headers or {}),
+            }
+            data = None
+            if payload is not None:
+                data = json.dumps({**payload, "model": ep.model}, ensure_ascii=False).encode('utf-8')
+
+            started = time.time()
+            try:
+                with tracing.span(f"upstream.{self.name}", method=method, base_url=ep.base_url) as span_attrs:
+                    response = requests.request(
+                        method,
+                        ep.url(path),
+                        headers=request_headers,
+                        data=data,
+                        timeout=attempt_timeout
+                    )
+                    span_attrs['status'] = response.status_code
+            except requests.exceptions.RequestException as e:
+                self.release(ep, time.time() - started, error=True)
+                logging.warning(f"[{self.name}] {ep!r} request failed: {str(e)}")
+                if not (idempotent or _is_connect_error(e)):
+                    raise
+                last_error = e
+                last_response = None
+                continue
+
+            self.release(
+                ep,
+                time.time() - started,
+                status_code=response.status_code,
+                retry_after=_parse_retry_after(response)
+            )
+            retry = response.status_code in FAILOVER_STATUS_CODES or (
+                idempotent and response.status_code in RETRYABLE_STATUS_CODES
+            )
+            if not retry:
+                return response, ep
+            logging.warning(f"[{self.name}] {ep!r} returned {response.status_code}, trying next upstream")
+            last_response = response
+            last_error = None
+
+        if last_response is not None:
+            return last_response, tried[-1]
+        raise last_error
+
+
+def _is_connect_error(error):
+    """True if the request never reached the upstream, so retrying elsewhere cannot duplicate it"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        # 连接建立后断开（ProtocolError 等）时上游可能已收到请求，不算连接失败
+        reason = getattr(error.args[0], 'reason', error.args[0])
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+def _parse_retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        return None
+
+
+vision_router = UpstreamRouter('vision', config.AI_UPSTREAMS)
+image_router = UpstreamRouter('image', config.IMAGE_UPSTREAMS)